@@ -105,6 +105,9 @@ class ChatClient:
 
         self.ai_button = tk.Button(button_frame, text="AIお助け", command=self.request_ai_help)
         self.ai_button.pack(side=tk.LEFT)
+
+        self.presence_button = tk.Button(button_frame, text="参加者", command=self.request_presence)
+        self.presence_button.pack(side=tk.LEFT, padx=(5, 0))
         # --- UI設定ここまで ---
 
         master.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -123,6 +126,17 @@ class ChatClient:
             if not send_message_to_server(self.sock, {"command": "AI_HELP", "payload": prompt}):
                 self.handle_disconnect()
 
+    def request_presence(self):
+        """現在オンラインの参加者一覧をサーバーに問い合わせる"""
+        if not self.is_connected:
+            messagebox.showwarning("未接続", "サーバーとの接続が切れています。")
+            return
+        if not send_message_to_server(self.sock, {"command": "Presence"}):
+            self.handle_disconnect()
+
+    def show_presence(self, usernames):
+        messagebox.showinfo("参加者", f"オンライン ({len(usernames)}人):\n" + "\n".join(usernames), parent=self.master)
+
     def select_and_send_image(self):
         """[新機能] 画像を選択してサーバーに送信する"""
         if not self.is_connected:
@@ -230,22 +244,34 @@ class ChatClient:
         # このサンプルではクライアント側での履歴保存は不要
         pass
 
+    def receive_reply(self):
+        """接続処理中に届いたPingに応答しつつ、次のメッセージを受信する"""
+        while True:
+            msg = receive_message(self.sock)
+            if msg is None or msg.get("command") != "Ping":
+                return msg
+            send_message_to_server(self.sock, {"command": "Pong"})
+
     def start_connection(self):
+        # 入力待ちの間にサーバーから切断されないよう、接続前にユーザー名を決める
+        self.username = simpledialog.askstring("ユーザー名", "ユーザー名を入力してください:", parent=self.master)
+        if not self.username: self.username = "Anonymous"
+        self.master.title(f"掲示板チャット - {self.username}")
         try:
             self.sock.connect((HOST, PORT))
-            msg = receive_message(self.sock)
+            msg = self.receive_reply()
             if msg is None or msg.get("command") != "ConnectionStart":
                 messagebox.showerror("接続エラー", "サーバーからの応答が不正です。")
                 self.master.destroy()
                 return
+            # サーバーのハートビート設定より長く無通信が続いたら recv をタイムアウトさせる
+            heartbeat = msg.get("payload") or {}
+            if "ping_timeout" in heartbeat:
+                self.sock.settimeout(heartbeat["ping_timeout"] + heartbeat.get("ping_interval", 0))
 
-            self.username = simpledialog.askstring("ユーザー名", "ユーザー名を入力してください:", parent=self.master)
-            if not self.username: self.username = "Anonymous"
-            self.master.title(f"掲示板チャット - {self.username}")
-            
             send_message_to_server(self.sock, {"command": "UserName", "payload": self.username})
             
-            response = receive_message(self.sock)
+            response = self.receive_reply()
             if response is None or response.get("command") != "NameRecieved":
                 messagebox.showerror("接続エラー", "ユーザー名の登録に失敗しました。")
                 self.master.destroy()
@@ -274,6 +300,15 @@ class ChatClient:
             if command == "BoardInfo":
                 payload = msg.get("payload", [])
                 self.master.after(0, self.update_chat_box, payload)
+            elif command == "Ping":
+                # 送信はメインスレッドで行い、画像送信などと混ざらないようにする
+                self.master.after(0, self.send_pong)
+            elif command == "Presence":
+                self.master.after(0, self.show_presence, msg.get("payload", []))
+
+    def send_pong(self):
+        if self.is_connected and not send_message_to_server(self.sock, {"command": "Pong"}):
+            self.handle_disconnect()
 
     def handle_disconnect(self):
         if not self.is_connected: return
@@ -286,6 +321,7 @@ class ChatClient:
         self.send_button.config(state='disabled')
         self.ai_button.config(state='disabled')
         self.image_button.config(state='disabled')
+        self.presence_button.config(state='disabled')
         self.master.title(f"掲示板チャット - {self.username} (切断)")
         try:
             self.sock.close()
@@ -4,16 +4,26 @@ document.addEventListener('DOMContentLoaded', () => {
     const sendBtn = document.getElementById('send-btn');
     const imageInput = document.getElementById('image-input-hidden');
     const aiBtn = document.getElementById('ai-btn');
-
-    let username = "";
-    // WebSocketサーバーに接続
-    const socket = new WebSocket('ws://10.101.223.218:8765');
+    const presenceBtn = document.getElementById('presence-btn');
+
+    // 入力待ちの間にサーバーから切断されないよう、接続前にユーザー名を決める
+    let username = prompt("ユーザー名を入力してください:", "Anonymous");
+    if (!username) username = "Anonymous";
+    // WebSocketサーバーに接続 (ページと同じオリジンのサーバーを使う)
+    const wsProtocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const socket = new WebSocket(`${wsProtocol}//${location.host}/`);
+
+    // 無通信が続いたら接続を閉じる (時間はサーバーのハートビート設定から決める)
+    let watchdog = null;
+    let watchdogMs = null;
+    const resetWatchdog = () => {
+        clearTimeout(watchdog);
+        if (watchdogMs) watchdog = setTimeout(() => socket.close(), watchdogMs);
+    };
 
     // 接続が開いたとき
     socket.onopen = () => {
         console.log("サーバーに接続しました。");
-        username = prompt("ユーザー名を入力してください:", "Anonymous");
-        if (!username) username = "Anonymous";
         // サーバーにユーザー名を送信
         socket.send(JSON.stringify({ command: "UserName", payload: username }));
     };
@@ -21,13 +31,22 @@ document.addEventListener('DOMContentLoaded', () => {
     // サーバーからメッセージを受信したとき
     socket.onmessage = (event) => {
         const data = JSON.parse(event.data);
+        if (data.command === "ConnectionStart" && data.payload) {
+            watchdogMs = (data.payload.ping_timeout + data.payload.ping_interval) * 1000;
+        }
+        resetWatchdog();
         if (data.command === "BoardInfo") {
             renderChatHistory(data.payload);
+        } else if (data.command === "Ping") {
+            socket.send(JSON.stringify({ command: "Pong" }));
+        } else if (data.command === "Presence") {
+            alert(`オンライン (${data.payload.length}人):\n${data.payload.join('\n')}`);
         }
     };
 
     // 接続が閉じたとき
     socket.onclose = () => {
+        clearTimeout(watchdog);
         console.log("サーバーから切断されました。");
         addMessage({ username: "Server", message: "サーバーとの接続が切れました。" });
     };
@@ -55,10 +74,10 @@ document.addEventListener('DOMContentLoaded', () => {
         const bodyDiv = document.createElement('div');
         bodyDiv.className = 'message-body';
 
-        if (msg.image_data) {
-            // 画像メッセージ
+        if (msg.image_url || msg.image_data) {
+            // 画像メッセージ (サーバーがBlobとして配信するURLを優先する)
             const img = document.createElement('img');
-            img.src = `data:image/png;base64,${msg.image_data}`;
+            img.src = msg.image_url || `data:image/png;base64,${msg.image_data}`;
             bodyDiv.appendChild(img);
         } else {
             // テキストメッセージ
@@ -108,6 +127,11 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // オンラインの参加者一覧を問い合わせる
+    presenceBtn.addEventListener('click', () => {
+        socket.send(JSON.stringify({ command: "Presence" }));
+    });
+
     sendBtn.addEventListener('click', sendTextMessage);
     msgInput.addEventListener('keypress', (e) => {
         if (e.key === 'Enter') sendTextMessage();
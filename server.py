@@ -1,6 +1,11 @@
 import socket
 import threading
 import json
+import heapq
+import itertools
+import struct
+import sys
+import time
 from datetime import datetime
 import os
 import google.generativeai as genai
@@ -9,6 +14,9 @@ import google.generativeai as genai
 HOST = '0.0.0.0'
 PORT = 12345
 CHAT_LOG_FILE = "chat_log.json"
+PING_INTERVAL = 15  # 無通信がこの秒数続いたクライアントにPingを送る
+PING_TIMEOUT = 60   # 無通信がこの秒数続いたクライアントは切断したとみなす
+SEND_TIMEOUT = 30   # 送信がこの秒数まったく進まなければ切断する (送信全体の時間は制限しない)
 # ---
 
 # --- Gemini API 設定 ---
@@ -26,8 +34,12 @@ except Exception as e:
     GEMINI_API_KEY = None
 # ---
 
-clients = []
-client_info = {}
+# 接続中のセッション: client_socket -> {"username", "addr", "last_seen", "send_lock"}
+sessions = {}
+sessions_lock = threading.Lock()
+# 無通信チェックの期限を管理するヒープ: (期限, 連番, client_socket)
+reaper_heap = []
+reaper_seq = itertools.count()
 board_messages = []
 
 # =================================================================
@@ -60,7 +72,9 @@ def send_message(client_socket, message_dict):
         header = len(message_bytes).to_bytes(4, 'big')
         client_socket.sendall(header + message_bytes)
         return True
-    except (ConnectionResetError, ConnectionAbortedError):
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, BlockingIOError, TimeoutError):
+        # BlockingIOError / TimeoutError は SO_SNDTIMEO による送信タイムアウト、
+        # BrokenPipeError はReaperが切断したソケットへの送信
         return False
     except Exception as e:
         print(f"[ERROR] メッセージの送信に失敗しました: {e}")
@@ -115,48 +129,146 @@ def save_chat_log():
             json.dump(board_messages, f, indent=2, ensure_ascii=False) # indentを2に変更
     except IOError: pass
 
+# =================================================================
+# ===== セッション管理とハートビート =====
+# =================================================================
+def set_send_timeout(client_socket, seconds):
+    """送信だけにタイムアウトを設定する (recv はブロッキングのまま、Reaperの shutdown で起こす)"""
+    if sys.platform == "win32":
+        value = struct.pack("L", int(seconds * 1000))  # DWORD (ミリ秒)
+    else:
+        value = struct.pack("ll", int(seconds), 0)  # struct timeval
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+
+def add_session(client_socket, addr):
+    # 読まなくなった相手への sendall が永久に止まらないようにする
+    set_send_timeout(client_socket, SEND_TIMEOUT)
+    now = time.monotonic()
+    with sessions_lock:
+        sessions[client_socket] = {"username": "", "addr": addr, "last_seen": now, "send_lock": threading.Lock()}
+        heapq.heappush(reaper_heap, (now + PING_INTERVAL, next(reaper_seq), client_socket))
+
+def touch_session(client_socket):
+    """受信のたびに最終通信時刻を更新する (ヒープは期限到来時に再登録する)"""
+    session = sessions.get(client_socket)
+    if session is not None:
+        session["last_seen"] = time.monotonic()
+
+def send_to_client(client_socket, message_dict):
+    """送信をセッションごとにロックし、複数スレッドからの送信が混ざらないようにする"""
+    session = sessions.get(client_socket)
+    if session is None: return False
+    with session["send_lock"]:
+        if client_socket not in sessions: return False  # ロック待ちの間に切断された
+        return send_message(client_socket, message_dict)
+
+def presence_list():
+    with sessions_lock:
+        return sorted(session["username"] for session in sessions.values() if session["username"])
+
+def evict_session(client_socket):
+    session = sessions.get(client_socket)
+    if session is None: return
+    print(f"[INFO] 応答のない接続を切断します: {session['username'] or session['addr']}")
+    remove_client(client_socket)
+    # 受信待ち・送信中のスレッドを起こして終了させる
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError: pass
+
+def send_pings(client_sockets):
+    """Pingを送る。送信中のセッションはロックを待たずに飛ばす"""
+    for client_socket in client_sockets:
+        session = sessions.get(client_socket)
+        if session is None: continue
+        # 別スレッドが送信中なら飛ばす (止まっていれば SEND_TIMEOUT かReaperの切断で解放される)
+        if not session["send_lock"].acquire(blocking=False): continue
+        try:
+            sent = client_socket in sessions and send_message(client_socket, {"command": "Ping"})
+        finally:
+            session["send_lock"].release()
+        if not sent:
+            evict_session(client_socket)
+
+def reap_idle_sessions():
+    """期限が来たセッションだけを調べ、無通信ならPing、応答がなければ切断する"""
+    while True:
+        time.sleep(1)
+        now = time.monotonic()
+        to_ping, to_evict = [], []
+        with sessions_lock:
+            while reaper_heap and reaper_heap[0][0] <= now:
+                _, _, client_socket = heapq.heappop(reaper_heap)
+                session = sessions.get(client_socket)
+                if session is None: continue  # 既に切断済み
+                idle = now - session["last_seen"]
+                if idle >= PING_TIMEOUT:
+                    to_evict.append(client_socket)
+                    continue
+                if idle >= PING_INTERVAL:
+                    # Pong の有無にかかわらず PING_INTERVAL ごとに再確認する
+                    to_ping.append(client_socket)
+                    deadline = min(now + PING_INTERVAL, session["last_seen"] + PING_TIMEOUT)
+                else:
+                    deadline = session["last_seen"] + PING_INTERVAL
+                heapq.heappush(reaper_heap, (deadline, next(reaper_seq), client_socket))
+
+        # 切断はブロックしないのでこのスレッドで行う
+        for client_socket in to_evict:
+            evict_session(client_socket)
+        # Pingの送信は相手次第で止まりうるため、別スレッドに任せる
+        if to_ping:
+            ping_thread = threading.Thread(target=send_pings, args=(to_ping,))
+            ping_thread.daemon = True
+            ping_thread.start()
+# =================================================================
+
 def broadcast_board_info():
     message_to_send = {"command": "BoardInfo", "payload": board_messages}
-    for client_socket in list(clients):
-        if not send_message(client_socket, message_to_send):
-            remove_client(client_socket)
+    for client_socket in list(sessions):
+        if not send_to_client(client_socket, message_to_send):
+            # 途中まで書いたフレームが残りうるので、接続ごと切断する
+            evict_session(client_socket)
 
 def remove_client(client_socket):
-    if client_socket in clients:
-        clients.remove(client_socket)
-    user_to_remove = None
-    for username, sock in client_info.items():
-        if sock == client_socket:
-            user_to_remove = username
-            break
-    if user_to_remove:
-        del client_info[user_to_remove]
-        print(f"[INFO] {user_to_remove} が切断しました。")
-        board_messages.append({"username": "Server", "message": f"{user_to_remove} が退出しました。", "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
-        save_chat_log()
-        broadcast_board_info()
+    with sessions_lock:
+        session = sessions.pop(client_socket, None)
+    if session and session["username"]:
+        print(f"[INFO] {session['username']} が切断しました。")
 
 def handle_client(client_socket, addr):
     print(f"[INFO] {addr} から新しい接続がありました。")
     username = ""
     try:
-        send_message(client_socket, {"command": "ConnectionStart"})
+        # クライアントが無通信を判定できるよう、ハートビートの設定を伝える
+        send_to_client(client_socket, {"command": "ConnectionStart", "payload": {"ping_interval": PING_INTERVAL, "ping_timeout": PING_TIMEOUT}})
         
         while True:
             msg = receive_message(client_socket)
             if msg is None: break
+            touch_session(client_socket)
             
             command = msg.get("command")
             payload = msg.get("payload")
 
             if command == "UserName":
                 username = payload
-                client_info[username] = client_socket
+                session = sessions.get(client_socket)
+                if session is None: break
+                session["username"] = username
                 print(f"[INFO] {addr} のユーザー名は {username} です。")
-                send_message(client_socket, {"command": "NameRecieved", "payload": username})
-                board_messages.append({"username": "Server", "message": f"{username} が参加しました。", "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
-                save_chat_log()
-                broadcast_board_info()
+                send_to_client(client_socket, {"command": "NameRecieved", "payload": username})
+                # 参加メッセージは掲示板に残さず、本人にだけ掲示板を送る
+                send_to_client(client_socket, {"command": "BoardInfo", "payload": board_messages})
+
+            elif command == "Ping":
+                send_to_client(client_socket, {"command": "Pong"})
+
+            elif command == "Pong":
+                pass  # 最終通信時刻の更新のみ
+
+            elif command == "Presence":
+                send_to_client(client_socket, {"command": "Presence", "payload": presence_list()})
             
             elif command == "Send":
                 print(f"[MESSAGE] {username}: {payload}")
@@ -184,8 +296,14 @@ def handle_client(client_socket, addr):
                 print(f"[INFO] {username} が正常に接続を終了しました。")
                 break
     finally:
+        session = sessions.get(client_socket)
         remove_client(client_socket)
-        client_socket.close()
+        if session is None:
+            client_socket.close()
+        else:
+            # 他スレッドの送信中にソケットを閉じないよう、送信ロックを取ってから閉じる
+            with session["send_lock"]:
+                client_socket.close()
 
 def main():
     global board_messages
@@ -197,9 +315,12 @@ def main():
         server_socket.bind((HOST, PORT))
         server_socket.listen(10)
         print(f"[INFO] サーバーが {HOST}:{PORT} で起動しました。")
+        reaper_thread = threading.Thread(target=reap_idle_sessions)
+        reaper_thread.daemon = True
+        reaper_thread.start()
         while True:
             client_socket, addr = server_socket.accept()
-            clients.append(client_socket)
+            add_session(client_socket, addr)
             thread = threading.Thread(target=handle_client, args=(client_socket, addr))
             thread.daemon = True
             thread.start()
@@ -210,7 +331,7 @@ def main():
     finally:
         print("[INFO] 最終的なチャットログを保存しています...")
         save_chat_log()
-        for client in clients:
+        for client in list(sessions):
             client.close()
         server_socket.close()
 
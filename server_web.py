@@ -1,15 +1,42 @@
 import asyncio
 import websockets
+from websockets.asyncio.server import serve
+from websockets.datastructures import Headers
+from websockets.http11 import Response
 import json
 from datetime import datetime
 import os
 import google.generativeai as genai
 import base64
+import binascii
+import gzip
+import hashlib
+import heapq
+import itertools
+import time
+from urllib.parse import urlsplit
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # --- 設定 (変更なし) ---
 HOST = '0.0.0.0'
 PORT = 8765
 CHAT_LOG_FILE = "chat_log.json"
+PING_INTERVAL = 15  # 無通信がこの秒数続いたクライアントにPingを送る
+PING_TIMEOUT = 60   # 無通信がこの秒数続いたクライアントは切断したとみなす
+
+# --- 静的ファイル配信の設定 ---
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_FILES = {
+    "index.html": "text/html; charset=utf-8",
+    "script.js": "text/javascript; charset=utf-8",
+    "style.css": "text/css; charset=utf-8",
+}
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
 
 # --- Gemini API 設定 ---
 try:
@@ -26,9 +53,21 @@ except Exception as e:
     GEMINI_API_KEY = None
 
 # --- WebSocket用のグローバル変数 ---
-CONNECTED_CLIENTS = set()
+# 接続中のセッション: websocket -> {"username", "last_seen"}
+SESSIONS = {}
+# 無通信チェックの期限を管理するヒープ: (期限, 連番, websocket)
+REAPER_HEAP = []
+REAPER_SEQ = itertools.count()
+# Reaperが起動した送信・切断タスク (GCされないよう参照を保持する)
+REAPER_TASKS = set()
 board_messages = []
 
+# --- HTTP配信用のグローバル変数 ---
+# パス -> アセット情報 (エンコーディングごとの本文, ETag, Content-Type, Cache-Control)
+STATIC_ASSETS = {}
+# 画像のBase64文字列 -> Blobのパス (board_messages自体は書き換えない)
+IMAGE_BLOB_PATHS = {}
+
 # --- チャットロジック (変更なし) ---
 def call_gemini_api(history, user_prompt):
     if not GEMINI_API_KEY: return "AI機能が設定されていません。"
@@ -70,34 +109,226 @@ def save_chat_log():
             json.dump(board_messages, f, indent=2, ensure_ascii=False)
     except IOError: pass
 
+# --- HTTP配信 (静的ファイル・画像Blob) ---
+def make_asset(body, content_type, cache_control, compress=True):
+    """本文を事前圧縮し、エンコーディングごとのETag付きアセット情報を作る"""
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    variants = {"identity": (body, f'"{digest}"')}
+    if compress:
+        gz_body = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(gz_body) < len(body):
+            variants["gzip"] = (gz_body, f'"{digest}-gz"')
+        if brotli is not None:
+            br_body = brotli.compress(body, quality=11)
+            if len(br_body) < len(body):
+                variants["br"] = (br_body, f'"{digest}-br"')
+    return {"digest": digest, "variants": variants, "content_type": content_type, "cache_control": cache_control}
+
+def build_static_assets():
+    """起動時にWebクライアントを読み込み、ハッシュ付きファイル名で登録する"""
+    hashed_names = {}
+    for name, content_type in STATIC_FILES.items():
+        if name == "index.html": continue
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            body = f.read()
+        asset = make_asset(body, content_type, CACHE_IMMUTABLE)
+        stem, ext = os.path.splitext(name)
+        hashed_names[name] = f"{stem}.{asset['digest']}{ext}"
+        STATIC_ASSETS[f"/{hashed_names[name]}"] = asset
+        # ハッシュなしのパスは毎回再検証させる
+        STATIC_ASSETS[f"/{name}"] = dict(asset, cache_control=CACHE_REVALIDATE)
+
+    # index.html 内の参照をハッシュ付きファイル名に書き換える
+    with open(os.path.join(STATIC_DIR, "index.html"), 'r', encoding='utf-8') as f:
+        html = f.read()
+    for name, hashed_name in hashed_names.items():
+        html = html.replace(f'"{name}"', f'"/{hashed_name}"')
+    index_asset = make_asset(html.encode('utf-8'), STATIC_FILES["index.html"], CACHE_REVALIDATE)
+    STATIC_ASSETS["/"] = index_asset
+    STATIC_ASSETS["/index.html"] = index_asset
+    print(f"[INFO] 静的ファイルを {len(STATIC_FILES)} 件読み込みました。(brotli: {'有効' if brotli else '無効'})")
+
+def sniff_image_type(data):
+    """画像のマジックバイトからContent-Typeと拡張子を判定する"""
+    if data.startswith(b'\x89PNG'): return "image/png", "png"
+    if data.startswith(b'\xff\xd8'): return "image/jpeg", "jpg"
+    if data.startswith(b'GIF8'): return "image/gif", "gif"
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP': return "image/webp", "webp"
+    return "application/octet-stream", "bin"
+
+def register_image_blob(msg):
+    """画像メッセージのデータをBlobとして登録する"""
+    image_data = msg["image_data"]
+    if image_data in IMAGE_BLOB_PATHS: return
+    try:
+        data = base64.b64decode(image_data)
+    except (binascii.Error, ValueError):
+        return
+    content_type, ext = sniff_image_type(data)
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    path = f"/blobs/{digest}.{ext}"
+    # 画像は既に圧縮済みのため事前圧縮はしない。
+    # 本文はboard_messages内のBase64を共有し、配信時に復元する (二重に保持しない)
+    STATIC_ASSETS.setdefault(path, {"digest": digest, "variants": {"identity": (None, f'"{digest}"')}, "content_type": content_type, "cache_control": CACHE_IMMUTABLE, "image_data": image_data})
+    IMAGE_BLOB_PATHS[image_data] = path
+
+def to_wire_message(msg):
+    """Blob化済みの画像はBase64本文を省き、URLだけを送る"""
+    path = IMAGE_BLOB_PATHS.get(msg.get("image_data"))
+    if path is None: return msg
+    wire_msg = {k: v for k, v in msg.items() if k != "image_data"}
+    wire_msg["image_url"] = path
+    return wire_msg
+
+def accepted_encodings(header_value):
+    """Accept-Encodingヘッダーから受け入れ可能なエンコーディングを取り出す"""
+    encodings = set()
+    for item in (header_value or "").split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding: continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try: q = float(value)
+                except ValueError: pass
+        if q > 0: encodings.add(coding)
+    return encodings
+
+def etag_matches(header_value, etag):
+    """If-None-Matchヘッダーが指定のETagに一致するか判定する (弱い比較)"""
+    if not header_value: return False
+    for tag in header_value.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.removeprefix('W/') == etag:
+            return True
+    return False
+
+def http_response(status, reason, headers, body=b""):
+    response_headers = Headers()
+    for key, value in headers.items():
+        response_headers[key] = value
+    # 304には本文がなく、Content-Lengthを付けるとキャッシュ側の長さを上書きされるため省く
+    if status != 304:
+        response_headers["Content-Length"] = str(len(body))
+    response_headers["Connection"] = "close"
+    return Response(status, reason, response_headers, body)
+
+def process_http_request(connection, request):
+    """WebSocket以外のHTTPリクエストに静的ファイル・Blobを返す"""
+    if request.headers.get("Upgrade", "").lower() == "websocket":
+        return None  # WebSocketのハンドシェイクを続行
+
+    asset = STATIC_ASSETS.get(urlsplit(request.path).path)
+    if asset is None:
+        return http_response(404, "Not Found", {"Content-Type": "text/plain; charset=utf-8"}, b"Not Found\n")
+
+    accepted = accepted_encodings(request.headers.get("Accept-Encoding"))
+    encoding = next((e for e in ("br", "gzip") if e in accepted and e in asset["variants"]), "identity")
+    body, etag = asset["variants"][encoding]
+    headers = {"ETag": etag, "Cache-Control": asset["cache_control"]}
+    if len(asset["variants"]) > 1:
+        headers["Vary"] = "Accept-Encoding"
+
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return http_response(304, "Not Modified", headers)
+
+    if body is None:
+        body = base64.b64decode(asset["image_data"])
+    headers["Content-Type"] = asset["content_type"]
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return http_response(200, "OK", headers, body)
+
 # --- WebSocket用の通信関数 ---
+def board_info_message():
+    return json.dumps({"command": "BoardInfo", "payload": [to_wire_message(m) for m in board_messages]})
+
 async def broadcast_board_info():
     """全クライアントに最新の掲示板情報をブロードキャストする"""
-    if CONNECTED_CLIENTS:
-        message_to_send = json.dumps({"command": "BoardInfo", "payload": board_messages})
+    if SESSIONS:
+        message_to_send = board_info_message()
         # ★★★ ここを修正 ★★★
         # asyncio.waitからasyncio.gatherに変更して、複数の非同期処理を同時に実行
-        await asyncio.gather(*[client.send(message_to_send) for client in CONNECTED_CLIENTS])
+        # 切断済みのクライアントがいても他のクライアントへの送信は続ける
+        await asyncio.gather(*[client.send(message_to_send) for client in list(SESSIONS)], return_exceptions=True)
+
+def presence_list():
+    return sorted(session["username"] for session in SESSIONS.values() if session["username"])
+
+async def send_quietly(websocket, message):
+    try:
+        await websocket.send(message)
+    except websockets.exceptions.ConnectionClosed: pass
+
+def start_reaper_task(coro):
+    task = asyncio.create_task(coro)
+    REAPER_TASKS.add(task)
+    task.add_done_callback(REAPER_TASKS.discard)
+
+async def reap_idle_sessions():
+    """期限が来たセッションだけを調べ、無通信ならPing、応答がなければ切断する"""
+    ping_message = json.dumps({"command": "Ping"})
+    while True:
+        await asyncio.sleep(1)
+        now = time.monotonic()
+        while REAPER_HEAP and REAPER_HEAP[0][0] <= now:
+            _, _, websocket = heapq.heappop(REAPER_HEAP)
+            session = SESSIONS.get(websocket)
+            if session is None: continue  # 既に切断済み
+            idle = now - session["last_seen"]
+            if idle >= PING_TIMEOUT:
+                print(f"[INFO] 応答のない接続を切断します: {session['username'] or websocket.remote_address}")
+                del SESSIONS[websocket]
+                # 相手が応答しなくても close_timeout 後に接続は破棄される
+                start_reaper_task(websocket.close())
+                continue
+            if idle >= PING_INTERVAL:
+                # Pong の有無にかかわらず PING_INTERVAL ごとに再確認する
+                start_reaper_task(send_quietly(websocket, ping_message))
+                deadline = min(now + PING_INTERVAL, session["last_seen"] + PING_TIMEOUT)
+            else:
+                deadline = session["last_seen"] + PING_INTERVAL
+            heapq.heappush(REAPER_HEAP, (deadline, next(REAPER_SEQ), websocket))
 
 # --- メインのクライアント処理 ---
 async def handle_client(websocket):
     """クライアントからの接続とメッセージを処理する"""
-    CONNECTED_CLIENTS.add(websocket)
+    now = time.monotonic()
+    session = {"username": "", "last_seen": now}
+    SESSIONS[websocket] = session
+    heapq.heappush(REAPER_HEAP, (now + PING_INTERVAL, next(REAPER_SEQ), websocket))
     username = "Anonymous"
     try:
         print(f"[INFO] 新しいクライアントが接続しました: {websocket.remote_address}")
-        await broadcast_board_info()
+        # クライアントが無通信を判定できるよう、ハートビートの設定を伝える
+        await websocket.send(json.dumps({"command": "ConnectionStart", "payload": {"ping_interval": PING_INTERVAL, "ping_timeout": PING_TIMEOUT}}))
+        # 参加メッセージは掲示板に残さず、本人にだけ掲示板を送る
+        await websocket.send(board_info_message())
 
         async for message in websocket:
+            session["last_seen"] = time.monotonic()
             data = json.loads(message)
             command = data.get("command")
             payload = data.get("payload")
 
             if command == "UserName":
                 username = payload
+                session["username"] = username
                 print(f"[INFO] ユーザー名を設定: {username}")
-                server_msg = {"username": "Server", "message": f"{username} が参加しました。", "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-                board_messages.append(server_msg)
+                continue
+
+            elif command == "Ping":
+                await websocket.send(json.dumps({"command": "Pong"}))
+                continue
+
+            elif command == "Pong":
+                continue  # 最終通信時刻の更新のみ
+
+            elif command == "Presence":
+                await websocket.send(json.dumps({"command": "Presence", "payload": presence_list()}))
+                continue
 
             elif command == "Send":
                 print(f"[MESSAGE] {username}: {payload}")
@@ -108,6 +339,7 @@ async def handle_client(websocket):
                 print(f"[IMAGE] {username} が画像を送信しました。")
                 img_data_b64 = payload.split(',')[1]
                 msg_data = {"username": username, "image_data": img_data_b64, "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+                register_image_blob(msg_data)
                 board_messages.append(msg_data)
 
             elif command == "AI_HELP":
@@ -123,22 +355,26 @@ async def handle_client(websocket):
         print(f"[INFO] クライアントが切断されました: {websocket.remote_address}")
     finally:
         # クライアントが切断した場合の処理
-        if websocket in CONNECTED_CLIENTS:
-            CONNECTED_CLIENTS.remove(websocket)
-        server_msg = {"username": "Server", "message": f"{username} が退出しました。", "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-        board_messages.append(server_msg)
-        save_chat_log()
-        await broadcast_board_info()
+        SESSIONS.pop(websocket, None)
+        print(f"[INFO] {username} が切断しました。")
 
 async def main():
     """サーバーを起動する"""
     global board_messages
     board_messages = load_chat_log()
     print(f"[INFO] 過去のチャットログを {len(board_messages)} 件読み込みました。")
+    for msg in board_messages:
+        if msg.get("image_data"):
+            register_image_blob(msg)
+    build_static_assets()
 
-    async with websockets.serve(handle_client, HOST, PORT):
-        print(f"[INFO] サーバーが ws://{HOST}:{PORT} で起動しました。")
-        await asyncio.Future()
+    # Webクライアント (HTTP) と WebSocket を同じポートで提供する
+    # process_request(connection, request) 形式のフックを使うため、新しいasyncio実装のサーバーを使う
+    # 無通信の判定はアプリ側のPing/Reaperに任せるため、ライブラリのkeepaliveは無効にする
+    async with serve(handle_client, HOST, PORT, process_request=process_http_request, ping_interval=None):
+        print(f"[INFO] サーバーが http://{HOST}:{PORT} (WebSocket: ws://{HOST}:{PORT}) で起動しました。")
+        # Reaperは終了しないので、サーバーの稼働中ずっと待つ (例外が起きればここで表面化する)
+        await reap_idle_sessions()
 
 if __name__ == "__main__":
     try: